@@ -7,17 +7,51 @@ import shutil
 import collections
 import glob
 import json
-import subprocess
 import tempfile
 import string
+import gzip
+import hashlib
+import time
+import zipfile
+import filecmp
+import HTMLParser
+import StringIO
+import urllib
+import urlparse
+import functools
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import socket
 
 import xml.etree.ElementTree as ET
+
+import governor
+
+# the scratch blocks pandoc filter, also used to render blocks ahead of pandoc
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "pandoc_scratchblocks"))
+import filter as scratchblocks
 try:
     import yaml
 except ImportError:
     print >> sys.stderr, "You need to install pyyaml using pip or easy_install, sorry"
     sys.exit(-10)
 
+try:
+    from fontTools import subset as font_subset
+except ImportError:
+    font_subset = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image as pil_image
+except ImportError:
+    pil_image = None
+
 Theme = collections.namedtuple('Theme','id name language stylesheets legal logo css_variables')
 Style = collections.namedtuple('Style', 'name html_template tex_template stylesheets')
 Language = collections.namedtuple('Language', 'code name legal translations')
@@ -32,14 +66,14 @@ template_base = os.path.join(base, "templates")
 theme_base = os.path.join(base, "themes")
 language_base = os.path.join(base, "languages")
 
-note_style = index_style = Style(
-    name = 'lesson', 
+note_style = Style(
+    name = 'note', 
     html_template = "template.html",
     tex_template = None,
     stylesheets = ["/css/main.css", "/css/notes.css"],
 )
 index_style = Style(
-    name = 'lesson', 
+    name = 'index', 
     html_template = "template.html",
     tex_template = None,
     stylesheets = ["/css/main.css", "/css/index.css"],
@@ -50,6 +84,7 @@ lesson_style = Style(
     tex_template = None,
     stylesheets = ["/css/main.css","/css/lesson.css"],
 )
+styles = (lesson_style, note_style, index_style)
 
 # todo : real classes
 
@@ -57,15 +92,43 @@ Term = collections.namedtuple('Term', 'id manifest title description language nu
 Project = collections.namedtuple('Project', 'filename number title materials note embeds')
 Extra = collections.namedtuple('Extra', 'name materials note')
 Resource = collections.namedtuple('Resource','format filename')
+CssBundle = collections.namedtuple('CssBundle', 'stylesheets critical fonts')
+Selection = collections.namedtuple('Selection', 'languages terms projects paths')
 
 css_assets = os.path.join(template_base,"css")
 
+# Bundled stylesheets for this build, keyed by (style name, stylesheet),
+# filled in by make_css_bundles and used by pandoc_html.
+css_bundles = {}
+
+# The directory of scratch block images for this build, set by make_blocks
+# and handed to the pandoc filter by pandoc_html.
+blocks_dir = None
+
+# The directory of resized embedded images, set by make_embeds and used
+# by responsive_images.
+embeds_dir = None
+
+# Rules for anything drawn above the fold, inlined when asked to.
+critical_selectors = re.compile(r'^(\*|html|body|header|\.level|\.title|\.logo|\.legal)(?![\w-])')
+
 scratchblocks_filter = os.path.join(base, "pandoc_scratchblocks/filter.py")
-html_assets = [os.path.join(base, "assets",x) for x in ("fonts", "img")]
+font_assets = os.path.join(base, "assets", "fonts")
+img_assets = os.path.join(base, "assets", "img")
+html_assets = [font_assets, img_assets]
+
+# The @font-face rules in main.css, used when writing subsetted fonts
+web_fonts = [
+    # (file name, family, weight, style)
+    ("PTSansRegular", "PTSans", "normal", "normal"),
+    ("PTSansItalic", "PTSans", "normal", "italic"),
+    ("PTSansBold", "PTSans", "bold", "normal"),
+    ("PTSansBoldItalic", "PTSans", "bold", "italic"),
+]
 
 # Markup processing
 
-def pandoc_html(input_file, style, language, theme, variables, commands, output_file):
+def pandoc_html(input_file, style, language, theme, variables, commands, output_file, stylesheet=None):
     legal = language.legal.get(theme.id, theme.legal)
 
     cmd = [
@@ -82,17 +145,29 @@ def pandoc_html(input_file, style, language, theme, variables, commands, output_
         "-M", "organization=%s"%theme.name,
         "-M", "logo=%s"%theme.logo,
     ]
-    for stylesheet in style.stylesheets:
-        cmd.extend(("-c", stylesheet,))
-    for stylesheet in theme.stylesheets:
-        cmd.extend(("-c", stylesheet,))
-    for k,v in variables.iteritems(): 
+    bundle = css_bundles.get((style.name, stylesheet))
+    if bundle:
+        for href in bundle.stylesheets:
+            cmd.extend(("-c", href,))
+        # the bundle already contains the document's own stylesheet
+        cmd.extend(("-M", "stylesheet=false"))
+        if bundle.critical:
+            cmd.extend(("-V", "critical_css=%s"%bundle.critical))
+        if bundle.fonts:
+            cmd.extend(("-V", "fonts_css=/fonts/%s/fonts.css"%language.code))
+    else:
+        for href in style.stylesheets:
+            cmd.extend(("-c", href,))
+        for href in theme.stylesheets:
+            cmd.extend(("-c", href,))
+    if blocks_dir:
+        cmd.extend(("-M", "%s=%s"%(scratchblocks.store_key, blocks_dir)))
+    for k,v in sorted(variables.iteritems()):
         cmd.extend(("-M", "%s=%s"%(k,v)))
-    
-    working_dir = os.path.dirname(output_file)
 
+    working_dir = os.path.dirname(output_file)
 
-    subprocess.check_call(cmd, cwd=working_dir)
+    governor.check_call("pandoc", cmd, cwd=working_dir)
 
 
 def pandoc_pdf(input_file, style, language, theme, variables, commands, output_file):
@@ -113,13 +188,13 @@ def pandoc_pdf(input_file, style, language, theme, variables, commands, output_f
     ]
     if style.tex_template:
         cmd.append("--template=%s"%os.path.join(template_base, style.tex_template))
-    for k,v in variables.iteritems(): 
+    for k,v in sorted(variables.iteritems()):
         cmd.extend(("-M", "%s=%s"%(k,v)))
     
     print " ".join([repr(s.encode('utf-8')) for s in cmd])
     working_dir = os.path.dirname(output_file)
 
-    return 0 == subprocess.call(cmd, cwd=working_dir)
+    return 0 == governor.call("pandoc", cmd, cwd=working_dir)
 
 
     
@@ -130,12 +205,14 @@ def markdown_to_pdf(markdown_file, style, language, theme, output_file):
 
     return pandoc_pdf(markdown_file, style, language, theme, {}, commands, output_file)
 
-def markdown_to_html(markdown_file, style, language, theme, output_file):
+def markdown_to_html(markdown_file, style, language, theme, output_file, variables=None):
     commands = (
         "-f", "markdown_github+header_attributes+yaml_metadata_block+inline_code_attributes",
     )
 
-    pandoc_html(markdown_file, style, language, theme, {}, commands, output_file)
+    header = parse_header(markdown_file) or {}
+
+    pandoc_html(markdown_file, style, language, theme, variables or {}, commands, output_file, header.get('stylesheet'))
 
 def make_html(variables, html, style, language, theme, output_file):
     variables = dict(variables)
@@ -151,12 +228,12 @@ def make_html(variables, html, style, language, theme, output_file):
     pandoc_html(input_file, style, language, theme, variables, commands, output_file)
 
 
-def process_file(input_file, style, language, theme, output_dir):
+def process_file(input_file, style, language, theme, output_dir, variables=None):
     output = []
     name, ext = os.path.basename(input_file).rsplit(".",1)
     if ext == "md":
         output_file = os.path.join(output_dir, "%s.html"%name)
-        markdown_to_html(input_file, style, language, theme, output_file)
+        markdown_to_html(input_file, style, language, theme, output_file, variables)
         output.append(Resource(filename=output_file, format="html"))
 
         output_file = os.path.join(output_dir, "%s.pdf"%name)
@@ -176,22 +253,30 @@ def build_project(term, project, language, theme, output_dir):
     input_file = project.filename
     name, ext = os.path.basename(input_file).rsplit(".",1)
 
-    output_files = process_file(input_file, lesson_style, language, theme, output_dir)
+    # the term's service worker, one directory up
+    variables = {'service_worker': "../%s"%service_worker_file}
+
+    output_files = process_file(input_file, lesson_style, language, theme, output_dir, variables)
 
     notes = []
 
     if project.note:
-        notes.extend(process_file(project.note, note_style, language, theme, output_dir))
+        notes.extend(process_file(project.note, note_style, language, theme, output_dir, variables))
     
     materials = None
     if project.materials:
-        zipfilename = "%s_%d-%02.d_%s_%s.zip" % (term.id, term.number, project.number, project.title, language.translate("resources"))
-        materials = zip_files(os.path.dirname(input_file), project.materials, output_dir, zipfilename)
+        materials = zip_files(os.path.dirname(input_file), project.materials, output_dir,
+            project_zip_name(term, project, language))
 
     embeds = []
     for file in project.embeds:
         embeds.append(copy_file(file, output_dir))
 
+    if embeds:
+        for r in output_files + notes:
+            if r.format == "html":
+                responsive_images(r.filename, project.embeds)
+
     return Project(
         filename = output_files,
         number = project.number,
@@ -205,13 +290,20 @@ def build_project(term, project, language, theme, output_dir):
 def build_extra(term, extra, language, theme, output_dir):
     note = []
     if extra.note:
-        note.extend(process_file(extra.note, note_style, language, theme, output_dir))
+        note.extend(process_file(extra.note, note_style, language, theme, output_dir,
+            {'service_worker': service_worker_file}))
     materials = None
     if extra.materials:
-        zipfilename = "%s_%d_%s_%s.zip" % (term.id, term.number, extra.name, language.translate("resources"))
-        materials = zip_files(os.path.dirname(term.manifest), extra.materials,output_dir, zipfilename)
+        materials = zip_files(os.path.dirname(term.manifest), extra.materials,output_dir,
+            extra_zip_name(term, extra, language))
     return Extra(name = extra.name, note=note, materials=materials)
 
+def project_zip_name(term, project, language):
+    return "%s_%d-%02.d_%s_%s.zip" % (term.id, term.number, project.number, project.title, language.translate("resources"))
+
+def extra_zip_name(term, extra, language):
+    return "%s_%d_%s_%s.zip" % (term.id, term.number, extra.name, language.translate("resources"))
+
 # Building indexes
 
 def sort_files(files):
@@ -221,7 +313,7 @@ def sort_files(files):
     }
     return sorted(files, key=lambda x:sort_key.get(x.format,0), reverse=True)
 
-def make_term_index(term, language, theme, output_dir):
+def make_term_index(term, language, theme, output_dir, site_dir):
 
     output_file = os.path.join(output_dir, "index.html")
     title = term.title
@@ -289,14 +381,19 @@ def make_term_index(term, language, theme, output_dir):
         
         
         if extra.materials: 
-            filename = extra.materials
-            url = os.path.relpath(filename, output_dir)
+            file = extra.materials
+            url = os.path.relpath(file.filename, output_dir)
             li = ET.SubElement(ol, 'li', {'class':'extramaterial'})
             a = ET.SubElement(li, 'a', {'href': url})
-            a.text = filename
+            a.text = os.path.basename(file.filename)
 
 
-    make_html({'title':title, 'level':"T%d"%term.number}, root, index_style, language, theme, output_file)
+    variables = {'title':title, 'level':"T%d"%term.number}
+    if site_dir:
+        variables['service_worker'] = service_worker_file
+    make_html(variables, root, index_style, language, theme, output_file)
+    if site_dir:
+        make_service_worker(output_dir, language, site_dir)
     return output_file, term
 
 
@@ -339,74 +436,97 @@ def make_index(languages, language, theme, output_dir):
 
 # The all singing all dancing build function of doing everything.
 
-def build(repositories, theme, all_languages, output_dir):
+def build(repositories, theme, all_languages, output_dir, inline_css=False, subset_fonts=False,
+        precompress=False, pool=None, selection=None):
+    """Build the site for theme from every manifest found in repositories.
 
-    print "Searching for manifests .."
+    Projects are built in parallel when a pool of workers is given. With a
+    selection, only the matching projects and extras are built, and the
+    indexes above them are rewritten from what earlier builds recorded in
+    each term's directory. The site wide assets are then written with the
+    options of the last full build, so the pages not built still match.
+    """
 
-    termlangs = {}
-    
-    for m in find_files(repositories, ".manifest"):
-        print "Found Manifest:", m
-        try:
-            term = parse_manifest(m)
-            if term.language not in termlangs:
-                termlangs[term.language] = []
-            termlangs[term.language].append(term)
-        except StandardError as e:
+    options = {'inline_css': inline_css, 'subset_fonts': subset_fonts, 'precompress': precompress}
+    if selection:
+        options = load_options(output_dir, options)
+        inline_css, subset_fonts, precompress = options['inline_css'], options['subset_fonts'], options['precompress']
+    if subset_fonts and font_subset is None:
+        raise StandardError("subset_fonts needs fonttools, install it using pip")
 
-            import traceback
-            traceback.print_exc()
-            print "Failed", e
+    print "Searching for manifests .."
+
+    termlangs = find_terms(repositories)
 
     print "Copying assets"
 
-    copydir(html_assets, output_dir)
-    css_dir = os.path.join(output_dir, "css")
-    makedirs(css_dir)
-    make_css(css_assets, theme, css_dir)
+    copy_assets(theme, output_dir, inline_css, subset_fonts)
+
+    print "Rendering scratch blocks"
+
+    make_blocks(termlangs, output_dir, pool, selection)
+
+    print "Resizing embedded images"
+
+    make_embeds(termlangs, output_dir, pool, selection)
 
     languages = {}
     project_count = {}
+    built_terms = []
+
+    for language_code, terms in sorted(termlangs.iteritems()):
+        language = find_language(all_languages, language_code)
+        lang_dir = os.path.join(output_dir, language.code)
+
+        languages[language_code] = os.path.join(lang_dir, "index.html")
+        project_count[language_code] = sum(len(term.projects) for term in terms)
+        if not any(selects_term(selection, term) for term in terms):
+            continue
 
-    for language_code, terms in termlangs.iteritems():
-        if language_code not in all_languages:
-            all_languages[language_code] = Language(
-                code = language_code,
-                name = language_code,
-                legal = {},
-                translations = {}
-            )
-        language = all_languages[language_code]
         print "Language", language.name
         out_terms = []
-        count = 0;
-        lang_dir = os.path.join(output_dir, language.code)
 
         for term in terms:
             term_dir = os.path.join(lang_dir, "%s.%d"%(term.id, term.number))
+            if not selects_term(selection, term):
+                out_terms.append((os.path.join(term_dir, "index.html"), term))
+                continue
+
             makedirs(term_dir)
-            
+
             print "Building Term:", term.title,
 
+            built = load_term(term_dir) if selection else None
+            built_projects = dict((p.number, p) for p in built.projects) if built else {}
+
             projects = []
-            
+            tasks = []
+
             for p in term.projects:
-                count+=1
                 project = parse_project_meta(p)
+                if not selects_project(selection, project) and project.number in built_projects:
+                    projects.append(built_projects[project.number])
+                    continue
+
                 print "Building Project:", project.title, project.filename
 
                 project_dir = os.path.join(term_dir,"%.02d"%(project.number))
                 makedirs(project_dir)
 
-                built_project = build_project(term, project, language, theme, project_dir)
-                
-                projects.append(built_project)
+                # filled in below, so projects stay in manifest order
+                projects.append(None)
+                tasks.append((term, project, language, theme, project_dir))
 
-            extras = []
-            
-            for r in term.extras:
-                print "Building Extra:", r.name
-                extras.append(build_extra(term, r, language, theme, term_dir))
+            built_now = iter(run_tasks(pool, build_project, tasks))
+            projects = [p or next(built_now) for p in projects]
+
+            if built and selection.projects:
+                extras = built.extras
+            else:
+                extras = []
+                for r in term.extras:
+                    print "Building Extra:", r.name
+                    extras.append(build_extra(term, r, language, theme, term_dir))
 
             term = Term(
                 id = term.id,
@@ -417,31 +537,531 @@ def build(repositories, theme, all_languages, output_dir):
                 extras = extras,
             )
 
-            out_terms.append(make_term_index(term, language, theme, term_dir))
+            save_term(term, term_dir)
+            out_terms.append(make_term_index(term, language, theme, term_dir, output_dir))
+            built_terms.append((term_dir, language))
 
             print "Term built!"
 
         print "Building",language.name,"index"
 
         languages[language_code]=make_lang_index(language, out_terms, theme, lang_dir)
-        project_count[language_code]=count
 
     print "Building", theme.name, "index"
 
     sorted_languages =  []
-    for lang in sorted(project_count.keys(), key=lambda x:project_count[x], reverse=True):
+    for lang in sorted(project_count.keys(), key=lambda x:(-project_count[x], x)):
         sorted_languages.append((all_languages[lang], languages[lang]))
 
 
     make_index(sorted_languages,all_languages[theme.language], theme, output_dir)
+
+    if subset_fonts:
+        print "Subsetting fonts"
+        charsets = {}
+        for language_code in languages:
+            lang_dir = os.path.join(output_dir, language_code)
+            charsets[language_code] = page_characters(find_files([lang_dir], ".html"))
+        root_chars = page_characters([os.path.join(output_dir, "index.html")])
+        charsets[theme.language] = charsets.get(theme.language, set()) | root_chars
+        make_fonts(charsets, output_dir)
+
+        # now the fonts exist, they can be precached too
+        for term_dir, language in built_terms:
+            make_service_worker(term_dir, language, output_dir)
+
+    if precompress:
+        print "Compressing"
+        make_compressed(output_dir, pool)
+    else:
+        remove_stale_compressed(output_dir)
+
+    if not selection:
+        save_options(output_dir, options)
+
     print "Complete"
-    
+
+def find_terms(repositories):
+    """Parse every manifest in repositories, into {language code: [Term]}"""
+    termlangs = {}
+
+    for m in find_files(repositories, ".manifest"):
+        print "Found Manifest:", m
+        try:
+            term = parse_manifest(m)
+            if term.language not in termlangs:
+                termlangs[term.language] = []
+            termlangs[term.language].append(term)
+        except StandardError as e:
+
+            import traceback
+            traceback.print_exc()
+            print "Failed", e
+    return termlangs
+
+def copy_assets(theme, output_dir, inline_css=False, subset_fonts=False):
+    if subset_fonts:
+        copydir([img_assets], output_dir)
+    else:
+        copydir(html_assets, output_dir)
+    css_dir = os.path.join(output_dir, "css")
+    makedirs(css_dir)
+    make_css(css_assets, theme, css_dir)
+    make_css_bundles(styles, theme, css_dir, inline_critical=inline_css, subset_fonts=subset_fonts)
+
+def find_language(all_languages, language_code):
+    """The language for language_code, adding a bare one if it is unknown."""
+    if language_code not in all_languages:
+        all_languages[language_code] = Language(
+            code = language_code,
+            name = language_code,
+            legal = {},
+            translations = {}
+        )
+    return all_languages[language_code]
+
+# Selecting part of a build
+
+def make_selection(languages=None, terms=None, projects=None, paths=None):
+    if languages or terms or projects or paths:
+        return Selection(
+            languages = languages or [],
+            terms = terms or [],
+            projects = [int(p) for p in projects or ()],
+            paths = paths or [],
+        )
+    return None
+
+def selects_term(selection, term):
+    if selection is None:
+        return True
+    if selection.languages and term.language not in selection.languages:
+        return False
+    if selection.terms and not set(selection.terms) & set([term.id, "%s.%d"%(term.id, term.number)]):
+        return False
+    if selection.paths and not any(touches_term(term, path) for path in selection.paths):
+        return False
+    return True
+
+def selects_project(selection, project):
+    return selection is None or not selection.projects or project.number in selection.projects
+
+def touches_term(term, path):
+    """True if path is the term's manifest, or is within or above its directory."""
+    term_dir = os.path.dirname(term.manifest)
+    return path == term.manifest or is_within(path, term_dir) or is_within(term_dir, path)
+
+def is_within(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+# What was built for each term is kept in its directory, so a later build
+# of part of the term can still write its index.
+
+built_term_file = ".term.json"
+
+def save_term(term, term_dir):
+    def resource(r):
+        if r:
+            return [r.format, os.path.relpath(r.filename, term_dir)]
+
+    obj = {
+        'projects': [{
+            'number': p.number,
+            'title': p.title,
+            'filename': [resource(r) for r in p.filename],
+            'note': [resource(r) for r in p.note],
+            'materials': resource(p.materials),
+            'embeds': [os.path.relpath(e, term_dir) for e in p.embeds],
+        } for p in term.projects],
+        'extras': [{
+            'name': e.name,
+            'note': [resource(r) for r in e.note],
+            'materials': resource(e.materials),
+        } for e in term.extras],
+    }
+    write_file(os.path.join(term_dir, built_term_file), json.dumps(obj, indent=1, sort_keys=True, separators=(',', ': ')))
+
+# The options of the last full build, kept so that a later build of part
+# of the site writes the site wide assets the same way.
+
+built_options_file = ".build.json"
+
+def save_options(output_dir, options):
+    write_file(os.path.join(output_dir, built_options_file),
+        json.dumps(options, indent=1, sort_keys=True, separators=(',', ': ')))
+
+def load_options(output_dir, options):
+    """The options of the last full build, or options if there was none."""
+    filename = os.path.join(output_dir, built_options_file)
+    if not os.path.exists(filename):
+        return options
+    built = load_json(filename)
+    if built != options:
+        print "Using the options of the last full build:", ", ".join(
+            "%s=%s"%(k, v) for k, v in sorted(built.iteritems()))
+    return built
+
+def load_term(term_dir):
+    """The projects and extras recorded by save_term, as a Term, or None."""
+    filename = os.path.join(term_dir, built_term_file)
+    if not os.path.exists(filename):
+        return None
+    obj = load_json(filename)
+
+    def resource(r):
+        if r:
+            return Resource(format=r[0], filename=os.path.join(term_dir, r[1]))
+
+    return Term(
+        id = None, manifest = None, title = None, description = None,
+        language = None, number = None,
+        projects = [Project(
+            filename = [resource(r) for r in p['filename']],
+            number = p['number'],
+            title = p['title'],
+            materials = resource(p['materials']),
+            note = [resource(r) for r in p['note']],
+            embeds = [os.path.join(term_dir, e) for e in p['embeds']],
+        ) for p in obj['projects']],
+        extras = [Extra(
+            name = e['name'],
+            note = [resource(r) for r in e['note']],
+            materials = resource(e['materials']),
+        ) for e in obj['extras']],
+    )
+
+def run_tasks(pool, fn, tasks):
+    if pool is None:
+        return [fn(*args) for args in tasks]
+    state = (css_bundles, blocks_dir, embeds_dir)
+    results = [pool.apply_async(run_task, (state, fn, args)) for args in tasks]
+    return [r.get() for r in results]
+
+def run_task(state, fn, args):
+    global blocks_dir, embeds_dir
+    # workers are forked before make_css_bundles, make_blocks and
+    # make_embeds run, so bring them up to date
+    bundles, blocks_dir, embeds_dir = state
+    css_bundles.clear()
+    css_bundles.update(bundles)
+    return fn(*args)
+
+def make_pool(jobs, recycle=None):
+    """A pool of jobs workers, each replaced after building recycle projects."""
+    if jobs > 1:
+        import multiprocessing
+        return multiprocessing.Pool(jobs, maxtasksperchild=recycle)
+    return None
+
+# Long running builds, driven over a unix socket by build_client.py
+
+status_marker = "!status "
+
+class SocketLog(object):
+    """Sends what is printed during a build back to the client, or drops
+    it once the client has gone, so the build still finishes.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.send('write', data)
+
+    def flush(self):
+        self.send('flush')
+
+    def send(self, method, *args):
+        if self.fh is None:
+            return
+        try:
+            getattr(self.fh, method)(*args)
+        except (socket.error, IOError):
+            print >> sys.__stderr__, "Client went away, carrying on with the build"
+            self.fh = None
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        log = SocketLog(self.wfile)
+        stdout, sys.stdout = sys.stdout, log
+        try:
+            self.server.build(request)
+            status = "ok"
+        except Exception as e:
+            import traceback
+            traceback.print_exc(file=log)
+            status = "failed %s"%e
+        finally:
+            sys.stdout = stdout
+        log.write("\n%s%s\n"%(status_marker, status))
+        log.flush()
+
+    def finish(self):
+        # what could not be sent to a client that has gone is still buffered
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+class BuildDaemon(SocketServer.UnixStreamServer):
+    """Serves build requests one at a time, keeping the parsed themes,
+    languages, manifests and headers, and a pool of workers around
+    between them.
+    """
+
+    def __init__(self, socket_path, jobs, recycle=None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, BuildRequestHandler)
+        self.pool = make_pool(jobs, recycle)
+
+    def build(self, request):
+        themes = load_themes(theme_base)
+        languages = load_languages(language_base)
+        theme = themes[request['region']]
+        output_dir = request['output']
+        if request.get('subset_fonts') and font_subset is None:
+            raise StandardError("subset_fonts needs fonttools, install it using pip")
+
+        selection = make_selection(request.get('languages'), request.get('terms'),
+            request.get('projects'), request.get('paths'))
+
+        build(request['repositories'], theme, languages, output_dir,
+            inline_css=request.get('inline_css', False),
+            subset_fonts=request.get('subset_fonts', False),
+            precompress=request.get('precompress', False),
+            pool=self.pool, selection=selection)
+
+# Previewing, building each page when it is first asked for
+
+Target = collections.namedtuple('Target', 'dependencies make')
+
+class PreviewSite(object):
+    """Maps the paths of the site onto the manifests, and builds the file
+    at a path when it is asked for, or again when what it was built from
+    has changed since.
+    """
+
+    def __init__(self, repositories, theme, all_languages, output_dir):
+        self.repositories = repositories
+        self.theme = theme
+        self.all_languages = all_languages
+        self.output_dir = output_dir
+        self.built = {}
+        self.target_map = None
+        self.sources = []
+        self.sources_version = None
+        copy_assets(theme, output_dir)
+        # blocks are rendered by the pandoc filter as pages are built
+        global blocks_dir
+        blocks_dir = os.path.join(output_dir, "blocks")
+        makedirs(blocks_dir)
+
+    def prepare(self, path):
+        path = os.path.normpath(path)
+        if path.split(os.sep)[0] in preview_assets:
+            return
+        target = self.targets().get(path)
+        if target is None:
+            return
+        filename = os.path.join(self.output_dir, path)
+        version = [os.path.getmtime(f) for f in target.dependencies if os.path.exists(f)]
+        if os.path.exists(filename) and self.built.get(path) == version:
+            return
+        print "Building", path
+        target.make()
+        self.built[path] = version
+
+    def targets(self):
+        """{path within the site: Target} for every page, index, embed and
+        zip, worked out again only when a manifest or project header changes.
+        """
+        if self.target_map is None or self.sources_version != modified_times(self.sources):
+            self.target_map, self.sources = self.make_targets()
+            self.sources_version = modified_times(self.sources)
+        return self.target_map
+
+    def make_targets(self):
+        theme = self.theme
+        template = os.path.join(template_base, index_style.html_template)
+        targets = {}
+        def add(filename, dependencies, make, *args):
+            path = os.path.relpath(filename, self.output_dir)
+            targets[path] = Target(list(dependencies) + [template], functools.partial(make, *args))
+
+        manifests = []
+        sources = []
+        languages = []
+        for language_code, terms in sorted(find_terms(self.repositories).iteritems()):
+            language = find_language(self.all_languages, language_code)
+            lang_dir = os.path.join(self.output_dir, language.code)
+            out_terms = []
+
+            for term in terms:
+                manifests.append(term.manifest)
+                term_dir = os.path.join(lang_dir, "%s.%d"%(term.id, term.number))
+                headers = []
+                projects = []
+                for p in term.projects:
+                    project = parse_project_meta(p)
+                    headers.append(project.filename)
+                    sources.append(project.filename)
+                    project_dir = os.path.join(term_dir, "%.02d"%(project.number))
+
+                    output_files = planned_files(project.filename, project_dir)
+                    for r in output_files:
+                        add(r.filename, [project.filename], self.make_file,
+                            project.filename, lesson_style, language, project_dir)
+                    notes = []
+                    if project.note:
+                        notes = planned_files(project.note, project_dir)
+                        for r in notes:
+                            add(r.filename, [project.note], self.make_file,
+                                project.note, note_style, language, project_dir)
+                    materials = None
+                    if project.materials:
+                        name = safe_filename(project_zip_name(term, project, language))
+                        materials = Resource(format="zip", filename=os.path.join(project_dir, name))
+                        add(materials.filename, project.materials, self.make_zip, os.path.dirname(project.filename),
+                            project.materials, project_dir, name)
+                    embeds = []
+                    for file in project.embeds:
+                        embeds.append(os.path.join(project_dir, os.path.basename(file)))
+                        add(embeds[-1], [file], self.make_copy, file, project_dir)
+
+                    projects.append(Project(filename=output_files, number=project.number, title=project.title,
+                        materials=materials, note=notes, embeds=embeds))
+
+                extras = []
+                for extra in term.extras:
+                    notes = []
+                    if extra.note:
+                        notes = planned_files(extra.note, term_dir)
+                        for r in notes:
+                            add(r.filename, [extra.note], self.make_file,
+                                extra.note, note_style, language, term_dir)
+                    materials = None
+                    if extra.materials:
+                        name = safe_filename(extra_zip_name(term, extra, language))
+                        materials = Resource(format="zip", filename=os.path.join(term_dir, name))
+                        add(materials.filename, extra.materials, self.make_zip, os.path.dirname(term.manifest),
+                            extra.materials, term_dir, name)
+                    extras.append(Extra(name=extra.name, note=notes, materials=materials))
+
+                planned = term._replace(projects=projects, extras=extras)
+                term_index = os.path.join(term_dir, "index.html")
+                add(term_index, [term.manifest] + headers, self.make_index, term_dir,
+                    make_term_index, planned, language, theme, term_dir, None)
+                out_terms.append((term_index, term))
+
+            lang_index = os.path.join(lang_dir, "index.html")
+            add(lang_index, [t.manifest for t in terms], self.make_index, lang_dir,
+                make_lang_index, language, out_terms, theme, lang_dir)
+            languages.append((sum(len(t.projects) for t in terms), language.code, language, lang_index))
+
+        languages = [(language, lang_index) for count, code, language, lang_index in
+            sorted(languages, key=lambda x:(-x[0], x[1]))]
+        add(os.path.join(self.output_dir, "index.html"), manifests, self.make_index, self.output_dir,
+            make_index, languages, self.all_languages[theme.language], theme, self.output_dir)
+        return targets, manifests + sources
+
+    def make_file(self, input_file, style, language, output_dir):
+        makedirs(output_dir)
+        # no service worker, so every page is built as it is asked for
+        process_file(input_file, style, language, self.theme, output_dir)
+
+    def make_zip(self, relative_dir, source_files, output_dir, name):
+        makedirs(output_dir)
+        zip_files(relative_dir, source_files, output_dir, name)
+
+    def make_copy(self, input_file, output_dir):
+        makedirs(output_dir)
+        copy_file(input_file, output_dir)
+
+    def make_index(self, output_dir, make, *args):
+        makedirs(output_dir)
+        make(*args)
+
+# Directories written by copy_assets and the build itself, never targets
+preview_assets = set(["css", "img", "fonts", "blocks", "embeds"])
+
+def modified_times(filenames):
+    return [os.path.getmtime(f) if os.path.exists(f) else None for f in filenames]
+
+def planned_files(input_file, output_dir):
+    """The files process_file will write for input_file."""
+    name, ext = os.path.basename(input_file).rsplit(".",1)
+    if ext == "md":
+        return [Resource(filename=os.path.join(output_dir, "%s.html"%name), format="html")]
+    return [Resource(filename=os.path.join(output_dir, os.path.basename(input_file)), format=ext)]
+
+class PreviewRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def send_head(self):
+        path = urllib.unquote(urlparse.urlparse(self.path).path).lstrip('/')
+        if not path or path.endswith('/'):
+            path += "index.html"
+        if os.path.basename(path) == service_worker_file:
+            return self.send_script(preview_service_worker)
+        try:
+            self.server.site.prepare(path)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.send_error(500, "Could not build %s: %s"%(path, e))
+            return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def send_script(self, filename):
+        with open(filename) as fh:
+            data = fh.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/javascript")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        return StringIO.StringIO(data)
+
+    def translate_path(self, path):
+        path = urllib.unquote(urlparse.urlparse(path).path)
+        return os.path.join(self.server.site.output_dir, os.path.normpath(path).lstrip('/'))
+
+def serve(port, repositories, theme, all_languages, output_dir):
+    makedirs(output_dir)
+    server = BaseHTTPServer.HTTPServer(('localhost', port), PreviewRequestHandler)
+    server.site = PreviewSite(repositories, theme, all_languages, output_dir)
+    print "Previewing on http://localhost:%d/"%port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
 # Manifest, Theme, Language, and Project Header Parsing
 
-def parse_manifest(filename):
+# Parsed files kept while they are unchanged, for long running builds,
+# {(loader, filename): (mtime, value)}
+parse_cache = {}
+
+def cached(load, filename):
+    key = (load.__name__, filename)
+    mtime = os.path.getmtime(filename)
+    if key in parse_cache and parse_cache[key][0] == mtime:
+        return parse_cache[key][1]
+    value = load(filename)
+    parse_cache[key] = (mtime, value)
+    return value
+
+def load_json(filename):
     with open(filename) as fh:
-        json_manifest = json.load(fh)
-    
+        return json.load(fh)
+
+def parse_manifest(filename):
+    json_manifest = cached(load_json, filename)
+    manifest = filename
+
     base_dir = os.path.join(os.path.dirname(filename))
 
     projects = []
@@ -482,7 +1102,7 @@ def parse_manifest(filename):
     m = Term(
         id = json_manifest['id'],
         title = json_manifest['title'],
-        manifest=filename,
+        manifest=manifest,
         description = json_manifest['description'],
         language = json_manifest['language'],
         number = int(json_manifest['number']),
@@ -500,9 +1120,8 @@ def load_languages(dir):
     return languages
 
 def parse_language(filename):
-    with open(filename) as fh:
-        obj = json.load(fh)
-    
+    obj = cached(load_json, filename)
+
     return Language(
         code = obj['code'],
         name = obj['name'],
@@ -518,9 +1137,8 @@ def load_themes(dir):
     return themes
 
 def parse_theme(filename):
-    with open(filename) as fh:
-        obj = json.load(fh)
-    
+    obj = cached(load_json, filename)
+
     return Theme(
         id = obj['id'],
         name = obj['name'],
@@ -532,11 +1150,11 @@ def parse_theme(filename):
     )
 
 
-def parse_project_meta(p):
-    if not p.filename.endswith('md'):
-        return p
+def parse_header(filename):
+    return cached(load_header, filename)
 
-    with open(p.filename) as fh:
+def load_header(filename):
+    with open(filename) as fh:
 
         in_header = False
         header_lines = []
@@ -548,7 +1166,13 @@ def parse_project_meta(p):
                 in_header = False
             elif in_header:
                 header_lines.append(line)
-    header = yaml.safe_load("".join(header_lines))
+    return yaml.safe_load("".join(header_lines))
+
+def parse_project_meta(p):
+    if not p.filename.endswith('md'):
+        return p
+
+    header = parse_header(p.filename)
 
     if header:
         title = header.get('title', p.title)
@@ -611,7 +1235,507 @@ def make_css(stylesheet_dir, theme, output_dir):
 
                 else:
                     shutil.copy(src, output_dir)
-    
+
+def make_css_bundles(styles, theme, css_dir, inline_critical=False, subset_fonts=False):
+    """Concatenate and minify each style's stylesheets, as written out by
+    make_css, into one file per style and optional document stylesheet.
+    """
+    css_bundles.clear()
+
+    used = set()
+    for style in styles:
+        used.update(style.stylesheets)
+    extras = [None]
+    for asset in sorted(os.listdir(css_dir)):
+        name, ext = os.path.splitext(asset)
+        if ext == '.css' and "/css/%s"%asset not in used and not name.endswith('.min'):
+            extras.append(name)
+
+    for style in styles:
+        for extra in extras:
+            hrefs = list(style.stylesheets)
+            if extra:
+                hrefs.append("/css/%s.css"%extra)
+            hrefs.extend(theme.stylesheets)
+
+            sources, external = [], []
+            for href in hrefs:
+                filename = os.path.join(css_dir, os.path.basename(href))
+                if href.startswith("/css/") and os.path.exists(filename):
+                    with open(filename) as fh:
+                        sources.append(fh.read())
+                else:
+                    external.append(href)
+
+            css = minify_css("\n".join(sources))
+            if subset_fonts:
+                # pages link their language's own @font-face rules instead
+                css = "".join(r for r in split_css_rules(css) if not r.startswith('@font-face'))
+            name = "-".join(x for x in (theme.id, style.name, extra) if x)
+            write_file(os.path.join(css_dir, "%s.min.css"%name), css)
+
+            critical = None
+            if inline_critical:
+                critical = "".join(r for r in split_css_rules(css) if is_critical_rule(r))
+
+            css_bundles[style.name, extra] = CssBundle(
+                stylesheets = ["/css/%s.min.css"%name] + external,
+                critical = critical,
+                fonts = subset_fonts,
+            )
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+def split_css_rules(css):
+    rules = []
+    depth = start = 0
+    for i, c in enumerate(css):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append(css[start:i+1])
+                start = i+1
+        elif c == ';' and depth == 0:
+            rules.append(css[start:i+1])
+            start = i+1
+    return rules
+
+def is_critical_rule(rule):
+    selectors = rule.split('{', 1)[0]
+    if selectors.startswith('@'):
+        return selectors == '@font-face'
+    return any(critical_selectors.match(s.strip()) for s in selectors.split(','))
+
+def page_characters(filenames):
+    """The set of code points used in the text of the given html pages,
+    in both cases, as the stylesheets capitalize some of it.
+    """
+    chars = set(range(0x20, 0x7f))
+    parser = HTMLParser.HTMLParser()
+    for filename in filenames:
+        with open(filename) as fh:
+            html = fh.read().decode('utf-8')
+        html = re.sub(r'(?is)<(script|style)\b.*?</\1>', '', html)
+        text = parser.unescape(re.sub(r'<[^>]*>', '', html))
+        chars.update(ord(c) for c in text)
+        chars.update(ord(c) for c in text.upper() + text.lower())
+    return chars
+
+def make_fonts(charsets, output_dir):
+    """Write /fonts/<lang>/ with the web fonts cut down to the characters
+    each language uses, and a fonts.css with matching @font-face rules.
+    """
+    flavors = ["woff"]
+    if brotli:
+        flavors.insert(0, "woff2")
+
+    for language_code, chars in sorted(charsets.iteritems()):
+        font_dir = os.path.join(output_dir, "fonts", language_code)
+        makedirs(font_dir)
+        rules = []
+        for name, family, weight, style in web_fonts:
+            src = os.path.join(font_assets, "%s.ttf"%name)
+            urls = []
+            for flavor in flavors:
+                options = font_subset.Options()
+                options.flavor = flavor
+                font = font_subset.load_font(src, options)
+                subsetter = font_subset.Subsetter(options)
+                subsetter.populate(unicodes=chars)
+                subsetter.subset(font)
+                font_subset.save_font(font, os.path.join(font_dir, "%s.%s"%(name, flavor)), options)
+                font.close()
+                urls.append("url('/fonts/%s/%s.%s') format('%s')"%(language_code, name, flavor, flavor))
+
+            rules.append("@font-face{font-family:'%s';src:%s;font-weight:%s;font-style:%s}"%(
+                family, ",".join(urls), weight, style))
+        write_file(os.path.join(font_dir, "fonts.css"), "".join(rules))
+
+# Scratch blocks, found in every markdown file before pandoc runs and each
+# rendered once into /blocks/<sha1>.png, where every page refers to them.
+# The pandoc filter renders any block the scan below misses.
+
+block_classes = set(["blocks", "scratch"])
+# blocks rendered by each phantomjs
+block_batch = 20
+
+fenced_code = re.compile(r'^([ \t]*)(`{3,}|~{3,})[ \t]*(\{[^}\n]*\}|[^\s`{]+)?[^\n]*\n(.*?)^[ \t]*\2[`~]*[ \t]*$', re.M | re.S)
+
+def make_blocks(termlangs, output_dir, pool=None, selection=None):
+    """Render the blocks of the selected terms that are not already in
+    output_dir/blocks, in batches spread over the pool.
+    """
+    global blocks_dir
+    blocks_dir = os.path.join(output_dir, "blocks")
+    makedirs(blocks_dir)
+
+    filenames = []
+    for language_code, terms in sorted(termlangs.iteritems()):
+        for term in terms:
+            if selects_term(selection, term):
+                filenames.extend(term_markdown(term))
+    blocks = find_blocks(filenames)
+
+    missing = [block for name, block in sorted(blocks.iteritems())
+        if not os.path.exists(os.path.join(blocks_dir, "%s.png"%name))]
+    tasks = [(missing[i:i+block_batch], blocks_dir) for i in range(0, len(missing), block_batch)]
+    run_tasks(pool, scratchblocks.render_block_images, tasks)
+
+    print "Rendered", len(missing), "of", len(blocks), "blocks"
+
+def term_markdown(term):
+    filenames = []
+    for p in term.projects:
+        project = parse_project_meta(p)
+        filenames.extend([project.filename, project.note])
+    filenames.extend(extra.note for extra in term.extras)
+    return [f for f in filenames if f and f.endswith(".md")]
+
+def find_blocks(filenames):
+    """{sha1: code} of the scratch blocks in the given markdown files."""
+    blocks = {}
+    for filename in filenames:
+        with open(filename) as fh:
+            text = fh.read().decode('utf-8')
+        for match in fenced_code.finditer(text):
+            indent, fence, attributes, code = match.groups()
+            attributes = attributes or ""
+            if attributes.startswith("{"):
+                classes = re.findall(r'\.([^\s.}]+)', attributes)
+            else:
+                classes = [attributes]
+            if block_classes.isdisjoint(classes):
+                continue
+            block = code_block_text(code, indent)
+            blocks[scratchblocks.block_name(block)] = block
+    return blocks
+
+def code_block_text(code, indent):
+    """The text pandoc gives a fenced code block, without the indent of
+    the list item it is in, and with tabs expanded.
+    """
+    lines = []
+    for line in code.split("\n")[:-1]:
+        if line.startswith(indent):
+            line = line[len(indent):]
+        lines.append(line.expandtabs(4))
+    return "\n".join(lines)
+
+# Embedded images, each resized to a few widths kept in /embeds and named
+# by the sha1 of the original, so unchanged images are not resized again.
+# Pages offer the browser these with srcset, and load them lazily.
+
+embed_formats = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG"}
+# the lesson column (see body in main.css) at 0.5, 1, 1.5 and 2 times
+embed_widths = [380, 760, 1140, 1520]
+embed_sizes = "(max-width: 800px) 100vw, 760px"
+
+img_tag = re.compile(r'<img\b([^>]*?)\s*/?>')
+html_attribute = re.compile(r'([\w-]+)="([^"]*)"')
+
+def make_embeds(termlangs, output_dir, pool=None, selection=None):
+    """Resize the embedded images of the selected terms that are not
+    already in output_dir/embeds, spread over the pool.
+    """
+    global embeds_dir
+    embeds_dir = os.path.join(output_dir, "embeds")
+    makedirs(embeds_dir)
+    if pil_image is None:
+        print "Not resizing embedded images, you need to install Pillow using pip"
+        return
+
+    sources = {}
+    for language_code, terms in sorted(termlangs.iteritems()):
+        for term in terms:
+            if not selects_term(selection, term):
+                continue
+            for p in term.projects:
+                for filename in parse_project_meta(p).embeds:
+                    if os.path.splitext(filename)[1].lower() in embed_formats:
+                        sources[file_hash(filename)] = filename
+
+    tasks = [(filename, name, embeds_dir) for name, filename in sorted(sources.iteritems())
+        if not os.path.exists(os.path.join(embeds_dir, "%s.json"%name))]
+    run_tasks(pool, make_embed_variants, tasks)
+
+    print "Resized", len(tasks), "of", len(sources), "images"
+
+def make_embed_variants(filename, name, output_dir):
+    """Write the image at each of embed_widths narrower than it, keeping
+    those smaller than the original, and a <name>.json recording its size
+    and theirs.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    image_format = embed_formats[ext]
+    original_size = os.path.getsize(filename)
+    image = pil_image.open(filename)
+    width, height = image.size
+    options = {'optimize': True}
+    if image.info.get('icc_profile'):
+        options['icc_profile'] = image.info['icc_profile']
+    if image.mode in ("1", "P"):
+        # resizing a palette would pick the nearest pixels
+        image = image.convert("RGBA")
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    variants = []
+    for w in embed_widths:
+        if w >= width:
+            break
+        h = max(1, int(round(height * w / float(width))))
+        variant = "%s-%d%s"%(name, w, ext)
+        out = StringIO.StringIO()
+        image.resize((w, h), pil_image.ANTIALIAS).save(out, image_format, **options)
+        if out.tell() >= original_size:
+            continue
+        write_file(os.path.join(output_dir, variant), out.getvalue())
+        variants.append([variant, w, h])
+
+    # written last, as it marks the image as done
+    record = {'width': width, 'height': height, 'variants': variants}
+    write_file(os.path.join(output_dir, "%s.json"%name), json.dumps(record, sort_keys=True))
+
+def has_resized_copies(filename):
+    if os.path.splitext(filename)[1].lower() not in embed_formats:
+        return False
+    record = embed_record(filename)
+    return bool(record and record['variants'])
+
+def embed_record(filename):
+    """What make_embed_variants recorded for an image, or None."""
+    if embeds_dir:
+        record_file = os.path.join(embeds_dir, "%s.json"%file_hash(filename))
+        if os.path.exists(record_file):
+            return load_json(record_file)
+
+def responsive_images(html_file, embeds):
+    """Rewrite the <img> tags in html_file that show one of embeds with
+    its size, its resized copies in srcset, and loading="lazy".
+    """
+    by_name = dict((os.path.basename(f), f) for f in embeds)
+
+    def rewrite(match):
+        attributes = html_attribute.findall(match.group(1))
+        src = dict(attributes).get('src', '')
+        filename = by_name.get(urllib.unquote(src))
+        if filename is None:
+            return match.group(0)
+
+        extra = [('loading', 'lazy')]
+        record = embed_record(filename)
+        if record:
+            if record['variants']:
+                srcset = ["/embeds/%s %dw"%(urllib.quote(v), w) for v, w, h in record['variants']]
+                srcset.append("%s %dw"%(src, record['width']))
+                extra.extend([('srcset', ", ".join(srcset)), ('sizes', embed_sizes)])
+            extra.extend([('width', str(record['width'])), ('height', str(record['height']))])
+
+        present = set(k for k, v in attributes)
+        attributes.extend((k, v) for k, v in extra if k not in present)
+        return "<img %s />"%" ".join('%s="%s"'%a for a in attributes)
+
+    with open(html_file) as fh:
+        html = fh.read()
+    write_file(html_file, img_tag.sub(rewrite, html))
+
+# Offline use, a service worker per term that precaches everything the
+# term's pages need, each with the hash of its content as its revision so
+# only what has changed is fetched again.
+
+service_worker_file = "sw.js"
+service_worker_template = os.path.join(template_base, "service_worker.js")
+preview_service_worker = os.path.join(template_base, "preview_service_worker.js")
+precache_file = "precache.json"
+not_precached = set([".zip", ".pdf", ".gz", ".br"])
+
+def make_service_worker(term_dir, language, site_dir):
+    entries = []
+    shared = set()
+    for dirname, dirs, names in os.walk(term_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if name.startswith('.') or name in (service_worker_file, precache_file):
+                continue
+            if os.path.splitext(name)[1] in not_precached:
+                continue
+            filename = os.path.join(dirname, name)
+            if has_resized_copies(filename):
+                # the service worker keeps whichever size is shown
+                continue
+            entries.append(precache_entry(filename, os.path.relpath(filename, term_dir)))
+            if name.endswith(".html"):
+                shared.update(page_assets(filename))
+
+    for url in sorted(shared):
+        filename = os.path.join(site_dir, url.lstrip("/"))
+        if os.path.exists(filename):
+            entries.append(precache_entry(filename, url))
+
+    for filename in site_assets(site_dir, language):
+        entries.append(precache_entry(filename, "/" + os.path.relpath(filename, site_dir)))
+
+    manifest = json.dumps(entries, indent=1, sort_keys=True, separators=(',', ': '))
+    write_file(os.path.join(term_dir, precache_file), manifest)
+
+    with open(service_worker_template) as fh:
+        template = string.Template(fh.read())
+    write_file(os.path.join(term_dir, service_worker_file), template.substitute(
+        cache = "lessons-%s"%os.path.relpath(term_dir, site_dir),
+        manifest = precache_file,
+        version = hashlib.sha1(manifest).hexdigest(),
+    ))
+
+def precache_entry(filename, path):
+    with open(filename, "rb") as fh:
+        revision = hashlib.sha1(fh.read()).hexdigest()[:12]
+    return {'url': urllib.pathname2url(path), 'revision': revision}
+
+shared_image = re.compile(r'%s[0-9a-f]{40}\.png'%re.escape(scratchblocks.store_url))
+
+def page_assets(filename):
+    """The urls of the block images a page shows, which are kept for the
+    whole site rather than in its term.
+    """
+    with open(filename) as fh:
+        return set(shared_image.findall(fh.read()))
+
+def site_assets(site_dir, language):
+    """The stylesheets, images and fonts used by every page in language."""
+    def files(dirname, extensions=None):
+        if not os.path.isdir(dirname):
+            return []
+        return [os.path.join(dirname, name) for name in sorted(os.listdir(dirname))
+            if not name.startswith('.') and os.path.isfile(os.path.join(dirname, name))
+            and (extensions is None or os.path.splitext(name)[1] in extensions)]
+
+    assets = [f for f in files(os.path.join(site_dir, "css")) if f.endswith(".min.css")]
+    assets.extend(files(os.path.join(site_dir, "img"), [".svg", ".png", ".gif", ".jpg"]))
+
+    if any(bundle.fonts for bundle in css_bundles.itervalues()):
+        font_dir = os.path.join(site_dir, "fonts", language.code)
+        fonts = files(font_dir, [".woff2"]) or files(font_dir, [".woff"])
+        fonts.extend(files(font_dir, [".css"]))
+    else:
+        fonts = files(os.path.join(site_dir, "fonts"), [".woff"])
+    assets.extend(fonts)
+    return assets
+
+# Precompressed copies of the output, for the web server to send as is
+
+compressible = set([".html", ".css", ".js", ".json", ".svg", ".xml", ".txt", ".ttf", ".eot"])
+compressed_formats = [".gz", ".br"]
+
+# For each file, its sha1 when its compressed copies were last written,
+# and which of them were kept, {path: {"sha1": sha1, "formats": {ext: kept}}}
+compressed_file = ".compressed.json"
+
+def make_compressed(output_dir, pool=None):
+    """Write .gz and, with brotli installed, .br copies of every text file
+    in output_dir, skipping those unchanged since the last time.
+    """
+    record_file = os.path.join(output_dir, compressed_file)
+    record = load_json(record_file) if os.path.exists(record_file) else {}
+    formats = compressed_formats if brotli else compressed_formats[:1]
+
+    hashes = {}
+    tasks = []
+    for dirname, dirs, names in os.walk(output_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            filename = os.path.join(dirname, name)
+            base_name, ext = os.path.splitext(filename)
+            if ext in compressed_formats:
+                if not os.path.exists(base_name):
+                    os.remove(filename)
+                continue
+            if ext not in compressible or name.startswith('.'):
+                continue
+
+            path = os.path.relpath(filename, output_dir)
+            hashes[path] = file_hash(filename)
+            if not compressed_current(filename, hashes[path], record.get(path), formats):
+                tasks.append((filename, formats))
+
+    if pool is None and len(tasks) > 1:
+        import multiprocessing
+        own_pool = pool = multiprocessing.Pool()
+    else:
+        own_pool = None
+    try:
+        results = run_tasks(pool, compress_file, tasks)
+    finally:
+        if own_pool:
+            own_pool.close()
+            own_pool.join()
+
+    kept = dict((os.path.relpath(filename, output_dir), result)
+        for (filename, tried), result in zip(tasks, results))
+    record = dict((path, {'sha1': sha1, 'formats': kept[path] if path in kept else record[path]['formats']})
+        for path, sha1 in hashes.iteritems())
+
+    print "Compressed", len(tasks), "of", len(hashes), "files"
+    write_file(record_file, json.dumps(record, indent=1, sort_keys=True, separators=(',', ': ')))
+
+def compressed_current(filename, sha1, entry, formats):
+    """True if the compressed copies of filename need not be written again."""
+    if not isinstance(entry, dict) or entry.get('sha1') != sha1:
+        return False
+    for ext in formats:
+        if ext not in entry['formats']:
+            return False
+        if entry['formats'][ext] and not os.path.exists(filename + ext):
+            return False
+    return True
+
+def remove_stale_compressed(output_dir):
+    """Remove the compressed copies of files changed since they were
+    written, for builds without --precompress.
+    """
+    record_file = os.path.join(output_dir, compressed_file)
+    if not os.path.exists(record_file):
+        return
+    record = load_json(record_file)
+    for path in sorted(record):
+        filename = os.path.join(output_dir, path)
+        entry = record[path]
+        if os.path.exists(filename) and isinstance(entry, dict) and entry.get('sha1') == file_hash(filename):
+            continue
+        for ext in compressed_formats:
+            if os.path.exists(filename + ext):
+                os.remove(filename + ext)
+        del record[path]
+    write_file(record_file, json.dumps(record, indent=1, sort_keys=True, separators=(',', ': ')))
+
+def compress_file(filename, formats):
+    """Write the compressed copies of filename, returning {ext: kept}."""
+    with open(filename, "rb") as fh:
+        data = fh.read()
+    kept = {}
+    for ext in formats:
+        if ext == ".gz":
+            out = StringIO.StringIO()
+            # no name or time in the header, so the same input gives the same bytes
+            with gzip.GzipFile(filename="", mode="wb", fileobj=out, compresslevel=9, mtime=0) as gz:
+                gz.write(data)
+            compressed = out.getvalue()
+        else:
+            compressed = brotli.compress(data, quality=11)
+
+        kept[ext] = len(compressed) < len(data)
+        if kept[ext]:
+            write_file(filename + ext, compressed)
+        elif os.path.exists(filename + ext):
+            os.remove(filename + ext)
+    return kept
+
 # File and directory handling
 
 def find_files(dir, extension):
@@ -622,13 +1746,12 @@ def find_files(dir, extension):
                 m.append(os.path.join(dirname, n))
     for d in dir:
         os.path.walk(d, visit, manifests)
-    
-        
-    return manifests
+
+    return sorted(manifests)
 
 def expand_glob(base_dir, paths, one_file=False):
     if one_file:
-        output = glob.glob(os.path.join(base_dir, paths))
+        output = sorted(glob.glob(os.path.join(base_dir, paths)))
         if len(output) != 1:
             raise AssertionError("Bad things")
         return output[0]
@@ -638,9 +1761,23 @@ def expand_glob(base_dir, paths, one_file=False):
         if not hasattr(paths, '__iter__'):
             paths = (paths,)
         for p in paths:
-            output.extend(glob.glob(os.path.join(base_dir, p)))
+            output.extend(sorted(glob.glob(os.path.join(base_dir, p))))
         return output
     
+def write_file(filename, data):
+    """Write data to filename, leaving it untouched if it is unchanged."""
+    if os.path.exists(filename):
+        with open(filename, "rb") as fh:
+            if fh.read() == data:
+                return False
+    with open(filename, "wb") as fh:
+        fh.write(data)
+    return True
+
+def file_hash(filename):
+    with open(filename, "rb") as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
 def makedirs(path, clear=False):
     if clear and os.path.exists(path):
         shutil.rmtree(path)
@@ -654,39 +1791,98 @@ def safe_filename(filename):
 def zip_files(relative_dir, source_files, output_dir, output_file):
     if source_files:
         output_file = os.path.join(output_dir, safe_filename(output_file))
-        cmd = [
-            'zip'
-        ]
         if os.path.exists(output_file):
             os.remove(output_file)
 
+        if 'SOURCE_DATE_EPOCH' in os.environ:
+            write_zip(relative_dir, source_files, output_file, int(os.environ['SOURCE_DATE_EPOCH']))
+            return Resource(format="zip", filename=output_file)
+
+        cmd = [
+            'zip'
+        ]
         cmd.append(output_file)
-        for file in source_files:
+        for file in sorted(source_files):
             cmd.append(os.path.relpath(file, relative_dir))
-        
-        ret = subprocess.call(cmd, cwd=relative_dir)
+
+        ret = governor.call("zip", cmd, cwd=relative_dir)
         if ret != 0 and ret != 12: # 12 means zip did nothing
             raise StandardError('zip failure %d'%ret)
         return Resource(format="zip", filename=output_file)
     else:
         return None
 
+def write_zip(relative_dir, source_files, output_file, timestamp):
+    """Zip source_files in a fixed order, with the same timestamp and
+    permissions for every entry, so the same files give the same bytes.
+    """
+    date_time = time.gmtime(max(timestamp, zip_epoch))[:6]
+    with zipfile.ZipFile(output_file, "w", zipfile.ZIP_DEFLATED) as zf:
+        for file in sorted(set(source_files)):
+            name = os.path.relpath(file, relative_dir)
+            if os.path.isdir(file):
+                info = zipfile.ZipInfo(name + "/", date_time)
+                info.external_attr = (040755 << 16) | 0x10
+                data = ""
+            else:
+                info = zipfile.ZipInfo(name, date_time)
+                info.external_attr = 0100644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(file, "rb") as fh:
+                    data = fh.read()
+            info.create_system = 3
+            zf.writestr(info, data)
+
+# the earliest time a zip file can hold, 1980-01-01
+zip_epoch = 315532800
+
+def compare_trees(left, right):
+    """Relative paths of the files that differ between two directories."""
+    def files(top):
+        found = set()
+        for dirname, dirs, names in os.walk(top):
+            for name in names:
+                found.add(os.path.relpath(os.path.join(dirname, name), top))
+        return found
+    left_files, right_files = files(left), files(right)
+    differences = left_files ^ right_files
+    for name in left_files & right_files:
+        if not filecmp.cmp(os.path.join(left, name), os.path.join(right, name), shallow=False):
+            differences.add(name)
+    return sorted(differences)
 
 def copydir(assets, output_dir):
+    """Copy assets into output_dir, leaving the files that are already the
+    same, and their compressed copies, as they are.
+    """
     for src in assets:
         asset = os.path.basename(src)
         if not asset.startswith('.'):
             dst = os.path.join(output_dir, asset)
-            if os.path.exists(dst):
-                if os.path.isdir(dst):
-                    shutil.rmtree(dst)
-                else:
-                    os.remove(dst)
-                    
             if os.path.isdir(src):
-                shutil.copytree(src, dst)
+                if os.path.exists(dst) and not os.path.isdir(dst):
+                    os.remove(dst)
+                makedirs(dst)
+                remove_stale(src, dst)
+                copydir([os.path.join(src, name) for name in sorted(os.listdir(src))], dst)
             else:
-                shutil.copy(src, output_dir)
+                if os.path.isdir(dst):
+                    shutil.rmtree(dst)
+                if not (os.path.exists(dst) and filecmp.cmp(src, dst, shallow=False)):
+                    shutil.copy(src, dst)
+
+def remove_stale(src, dst):
+    """Remove what is in dst but no longer in src."""
+    names = set(name for name in os.listdir(src) if not name.startswith('.'))
+    for name in os.listdir(dst):
+        base_name, ext = os.path.splitext(name)
+        if name in names or (ext in compressed_formats and base_name in names):
+            continue
+        filename = os.path.join(dst, name)
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
 
 
 def copy_file(input_file, output_dir):
@@ -699,18 +1895,102 @@ THEMES = load_themes(theme_base)
 LANGUAGES = load_languages(language_base)
 
 if __name__ == '__main__':
-    args = sys.argv[1::]
-    if len(args) < 3:
-        print "usage: %s <region> <input repository directories> <output directory>"
-        sys.exit(-1)
-
-    theme = THEMES[args[0]]
+    import argparse
+
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] <region> <input repository directories> <output directory>\n"
+        "       %(prog)s [options] --daemon <socket>")
+    parser.add_argument("region", nargs="?")
+    parser.add_argument("paths", nargs="*", metavar="directory")
+    parser.add_argument("--inline-css", action="store_true",
+        help="inline the above the fold css into every page")
+    parser.add_argument("--subset-fonts", action="store_true",
+        help="cut the web fonts down to the characters each language uses")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of projects to build at once")
+    parser.add_argument("--recycle", type=int, default=50, metavar="n",
+        help="replace each worker after it has built n projects")
+    parser.add_argument("--memory", type=int, metavar="MB",
+        help="memory to share between pandoc, phantomjs and zip (default: 3/4 of what is free)")
+    parser.add_argument("--reproducible", action="store_true",
+        help="write zip files with fixed timestamps, from SOURCE_DATE_EPOCH if set")
+    parser.add_argument("--check-reproducible", action="store_true",
+        help="build a second time into a temporary directory and compare the two")
+    parser.add_argument("--precompress", action="store_true",
+        help="write .gz and .br copies of the text files for the web server")
+    parser.add_argument("--lang", action="append", metavar="code",
+        help="only build terms in this language, e.g. nb-NO")
+    parser.add_argument("--term", action="append", metavar="id",
+        help="only build this term, by id or id.number, e.g. scratch.1")
+    parser.add_argument("--project", action="append", type=int, metavar="number",
+        help="only build projects with this number")
+    parser.add_argument("--serve", type=int, metavar="port",
+        help="serve a preview of the site, building each page when it is asked for")
+    parser.add_argument("--daemon", metavar="socket",
+        help="wait for builds requested by build_client.py on this unix socket")
+    args = parser.parse_args()
+
+    governor.configure(args.memory * 1024 if args.memory else None)
+    if args.reproducible or args.check_reproducible:
+        os.environ.setdefault('SOURCE_DATE_EPOCH', str(zip_epoch))
+
+    if args.daemon:
+        daemon = BuildDaemon(args.daemon, args.jobs, args.recycle)
+        print "Waiting for builds on", args.daemon
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.daemon)
+            governor.cleanup()
+        sys.exit(0)
+
+    if args.region not in THEMES:
+        parser.error("region must be one of %s"%", ".join(sorted(THEMES)))
+    if len(args.paths) < 2:
+        parser.error("need at least one input repository and an output directory")
+    if args.subset_fonts and font_subset is None:
+        parser.error("--subset-fonts needs fonttools, install it using pip")
+
+    theme = THEMES[args.region]
     languages = LANGUAGES
-    args = [os.path.abspath(a) for a in args[1:]]
+    paths = [os.path.abspath(a) for a in args.paths]
 
-    repositories, output_dir = args[:-1], args[-1]
+    repositories, output_dir = paths[:-1], paths[-1]
 
-    build(repositories, theme, languages, output_dir)
+    if args.serve:
+        try:
+            serve(args.serve, repositories, theme, languages, output_dir)
+        finally:
+            governor.cleanup()
+        sys.exit(0)
+
+    selection = make_selection(args.lang, args.term, args.project)
+    if selection and args.check_reproducible:
+        parser.error("--check-reproducible needs a full build")
+    options = dict(
+        inline_css = args.inline_css,
+        subset_fonts = args.subset_fonts,
+        precompress = args.precompress,
+        pool = make_pool(args.jobs, args.recycle),
+        selection = selection,
+    )
+    try:
+        build(repositories, theme, languages, output_dir, **options)
+
+        if args.check_reproducible:
+            check_dir = tempfile.mkdtemp(prefix="lesson_check")
+            try:
+                build(repositories, theme, dict(languages), check_dir, **options)
+                differences = compare_trees(output_dir, check_dir)
+            finally:
+                shutil.rmtree(check_dir)
+            for name in differences:
+                print "Not reproducible:", name
+            if differences:
+                sys.exit(-1)
+            print "Reproducible"
+    finally:
+        governor.cleanup()
 
     sys.exit(0)
-
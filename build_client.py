@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Ask a build daemon, started with `build.py --daemon <socket>`, to build
+the site, printing its output as it goes.
+
+With --rebuild, --lang, --term or --project, only the matching terms and
+projects are built again, as with `build.py --lang` and so on. --rebuild
+selects the terms whose manifest or directory contains the given path.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+
+status_marker = "!status "
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] <socket> <region> <input repository directories> <output directory>")
+    parser.add_argument("socket")
+    parser.add_argument("region")
+    parser.add_argument("paths", nargs="+", metavar="directory")
+    parser.add_argument("--rebuild", action="append", default=[], metavar="path",
+        help="a manifest, or a file or directory within a term, to rebuild")
+    parser.add_argument("--lang", action="append", default=[], metavar="code")
+    parser.add_argument("--term", action="append", default=[], metavar="id")
+    parser.add_argument("--project", action="append", default=[], type=int, metavar="number")
+    parser.add_argument("--inline-css", action="store_true")
+    parser.add_argument("--subset-fonts", action="store_true")
+    parser.add_argument("--precompress", action="store_true")
+    args = parser.parse_args()
+    if len(args.paths) < 2:
+        parser.error("need at least one input repository and an output directory")
+
+    paths = [os.path.abspath(a) for a in args.paths]
+    request = {
+        'region': args.region,
+        'repositories': paths[:-1],
+        'output': paths[-1],
+        'paths': [os.path.abspath(p) for p in args.rebuild],
+        'languages': args.lang,
+        'terms': args.term,
+        'projects': args.project,
+        'inline_css': args.inline_css,
+        'subset_fonts': args.subset_fonts,
+        'precompress': args.precompress,
+    }
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    fh = sock.makefile('rwb')
+    fh.write(json.dumps(request) + "\n")
+    fh.flush()
+
+    status = "failed, no reply from the daemon"
+    for line in fh:
+        if line.startswith(status_marker):
+            status = line[len(status_marker):].strip()
+        else:
+            sys.stdout.write(line)
+    sock.close()
+
+    if status != "ok":
+        print >> sys.stderr, status
+        sys.exit(-1)
+    sys.exit(0)
@@ -0,0 +1,260 @@
+"""
+Runs the external tools used by the build (pandoc, phantomjs, zip).
+
+Each run has a timeout, after which the process and its children are
+killed and the run retried with a growing delay between attempts.
+
+When a build calls configure(), every run, across all the processes of
+the build and whatever the tool, first reserves the peak memory its tool
+has needed so far from one shared budget, waiting while the runs already
+going would leave too little. The reservations and the peak memory of
+each tool are kept in a state directory, which child processes find
+through the environment.
+
+A run started from inside another run, such as phantomjs from the pandoc
+filter, is part of that run: it reserves nothing of its own, its memory is
+added to the outer run's peak, and it stays in the outer run's process
+group, so killing the outer run kills it too.
+"""
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import errno
+import signal
+import shutil
+import tempfile
+import subprocess
+import collections
+
+Tool = collections.namedtuple('Tool', 'timeout retries memory')
+
+# timeout in seconds, retries after a timeout, and memory in KB assumed
+# until a run has been measured
+tools = {
+    'pandoc': Tool(timeout=300, retries=1, memory=200*1024),
+    'phantomjs': Tool(timeout=60, retries=2, memory=150*1024),
+    # many blocks at once, see build.block_batch
+    'phantomjs_batch': Tool(timeout=300, retries=1, memory=200*1024),
+    'zip': Tool(timeout=120, retries=1, memory=16*1024),
+}
+default_tool = Tool(timeout=300, retries=0, memory=100*1024)
+
+state_var = "LESSON_GOVERNOR_DIR"
+memory_var = "LESSON_GOVERNOR_MEMORY"
+# set for the processes of a run, to a file its inner runs add their peaks to
+run_var = "LESSON_GOVERNOR_RUN"
+
+class CommandTimeout(StandardError):
+    pass
+
+def configure(memory=None):
+    """Share a memory budget, in KB, between this process and its children.
+
+    Without a budget, three quarters of the memory available now is used.
+    """
+    if memory is None:
+        memory = available_memory() * 3 // 4
+    os.environ[state_var] = tempfile.mkdtemp(prefix="lesson_governor")
+    os.environ[memory_var] = str(memory)
+
+def cleanup():
+    state_dir = os.environ.pop(state_var, None)
+    os.environ.pop(memory_var, None)
+    if state_dir:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+def available_memory():
+    try:
+        with open("/proc/meminfo") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 2*1024*1024
+
+def call(tool, cmd, cwd=None):
+    """Run cmd like subprocess.call, raising CommandTimeout if every attempt
+    timed out.
+    """
+    config = tools.get(tool, default_tool)
+    for attempt in range(config.retries + 1):
+        if attempt:
+            delay = 2 ** (attempt - 1)
+            print >> sys.stderr, "%s timed out, retrying in %ds"%(tool, delay)
+            time.sleep(delay)
+        reserved = acquire(tool, config)
+        try:
+            ret = run(tool, cmd, cwd, config.timeout)
+        finally:
+            if reserved:
+                release()
+        if ret is not None:
+            return ret
+    raise CommandTimeout("%s timed out %d times: %s"%(tool, config.retries + 1, " ".join(cmd)))
+
+def check_call(tool, cmd, cwd=None):
+    ret = call(tool, cmd, cwd)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+    return ret
+
+def run(tool, cmd, cwd, timeout):
+    """The return code of cmd, or None if it was killed for taking too long."""
+    outer_file = os.environ.get(run_var)
+    fd, run_file = tempfile.mkstemp(prefix="lesson_run")
+    os.close(fd)
+    env = dict(os.environ)
+    env[run_var] = run_file
+    try:
+        if outer_file:
+            # stay in the outer run's process group, and kill just this one
+            process = subprocess.Popen(cmd, cwd=cwd, env=env)
+            kill = os.kill
+        else:
+            process = subprocess.Popen(cmd, cwd=cwd, env=env, preexec_fn=os.setsid)
+            kill = os.killpg
+        deadline = time.time() + timeout
+        delay = 0.01
+        own_peak = 0
+        while True:
+            own_peak = max(own_peak, peak_memory(process.pid))
+            pid, status, usage = wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.time() > deadline:
+                try:
+                    kill(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                wait4(process.pid, 0)
+                process.returncode = -signal.SIGKILL
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+        if own_peak:
+            # this process and, added up, the largest of its inner runs
+            peak = own_peak + read_memory(run_file)
+        else:
+            peak = usage.ru_maxrss
+        record_memory(tool, peak)
+        if outer_file:
+            add_memory(outer_file, peak)
+    finally:
+        os.remove(run_file)
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode
+
+def peak_memory(pid):
+    """The most memory, in KB, the process itself has used so far, or 0."""
+    try:
+        with open("/proc/%d/status"%pid) as fh:
+            match = re.search(r'^VmHWM:\s*(\d+)', fh.read(), re.M)
+    except IOError:
+        return 0
+    return int(match.group(1)) if match else 0
+
+def wait4(pid, options):
+    while True:
+        try:
+            return os.wait4(pid, options)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+# Memory accounting, shared through the state directory
+
+reserved_file = "reserved.json"
+
+def acquire(tool, config):
+    """Wait until the tool's peak memory fits in what is left of the
+    budget, and reserve it, returning False for an inner run.
+    """
+    state_dir = os.environ.get(state_var)
+    if not state_dir or os.environ.get(run_var):
+        return False
+    budget = int(os.environ.get(memory_var, 0))
+    need = measured_memory(tool) or config.memory
+    while True:
+        with reservations(state_dir) as reserved:
+            # one run at a time can always go, however much it needs
+            if not reserved or sum(reserved.values()) + need <= budget:
+                reserved[str(os.getpid())] = need
+                return True
+        time.sleep(0.05)
+
+def release():
+    with reservations(os.environ[state_var]) as reserved:
+        reserved.pop(str(os.getpid()), None)
+
+class reservations(object):
+    """The memory reserved by each process, {pid: KB}, locked and written
+    back afterwards, leaving out processes that have died.
+    """
+
+    def __init__(self, state_dir):
+        self.filename = os.path.join(state_dir, reserved_file)
+        self.lock = os.path.join(state_dir, reserved_file + ".lock")
+
+    def __enter__(self):
+        self.lock_fh = open(self.lock, "a")
+        fcntl.flock(self.lock_fh, fcntl.LOCK_EX)
+        try:
+            with open(self.filename) as fh:
+                self.reserved = json.load(fh)
+        except (IOError, ValueError):
+            self.reserved = {}
+        for pid in list(self.reserved):
+            if not is_running(int(pid)):
+                del self.reserved[pid]
+        return self.reserved
+
+    def __exit__(self, *exc):
+        with open(self.filename, "w") as fh:
+            json.dump(self.reserved, fh)
+        self.lock_fh.close()
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def measured_memory(tool):
+    state_dir = os.environ.get(state_var)
+    if state_dir:
+        return read_memory(os.path.join(state_dir, "%s.rss"%tool)) or None
+
+def read_memory(filename):
+    try:
+        with open(filename) as fh:
+            return int(fh.read() or 0)
+    except (IOError, ValueError):
+        return 0
+
+def record_memory(tool, rss):
+    """Keep the largest peak memory seen for tool."""
+    state_dir = os.environ.get(state_var)
+    if not state_dir or rss <= (measured_memory(tool) or 0):
+        return
+    write_memory(os.path.join(state_dir, "%s.rss"%tool), rss)
+
+def add_memory(run_file, rss):
+    """Keep the largest peak of the inner runs of a run."""
+    if rss > read_memory(run_file):
+        write_memory(run_file, rss)
+
+def write_memory(filename, rss):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, "w") as fh:
+        fh.write(str(rss))
+    os.rename(tmp, filename)
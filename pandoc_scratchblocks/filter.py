@@ -6,46 +6,104 @@ import sys
 import os
 import os.path
 import hashlib
-import subprocess
 from string import Template
 
 from tempfile import mkdtemp
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import governor
+
 def sha1(x):
   return hashlib.sha1(x).hexdigest()
 
-base = os.path.dirname(__file__)
+base = os.path.dirname(os.path.abspath(__file__))
 scratchblocks2 = os.path.join(base, "scratchblocks2")
 rasterize = os.path.join(base, "rasterize.js")
+rasterize_batch = os.path.join(base, "rasterize_batch.js")
 jquery = os.path.join(base, "jquery.min.js")
 
 with open(os.path.join(base, "scratch_template.html")) as fh:
     html_template = Template(fh.read())
 
+# build.py renders the blocks of the whole site into one directory, given
+# to the filter in the document's metadata, and served from store_url.
+store_key = "blocks_dir"
+store_url = "/blocks/"
+
 tempdir = None
 
+def block_name(block):
+    return sha1(block.encode('utf-8'))
+
+def make_tempdir():
+    tempdir = mkdtemp()
+    shutil.copytree(scratchblocks2, os.path.join(tempdir, "scratchblocks2"))
+    shutil.copy(jquery, tempdir)
+    return tempdir
+
+def write_page(block, html_file):
+    with open(html_file,"wb") as fh:
+        raw = html_template.substitute(block=block.encode('utf-8'))
+        fh.write(raw)
+
+def partial_image(output_dir, name):
+    # phantomjs picks the format from the extension, so keep .png, and
+    # rename into place once written so no one sees half an image
+    return os.path.join(output_dir, ".%s.%d.png"%(name, os.getpid()))
+
 def block_to_image(block, output_dir):
-    block = block.encode('utf-8')
-    name = sha1(block)
+    name = block_name(block)
     html_file = os.path.join(tempdir, "%s.html"%(name))
     image_file = os.path.join(output_dir, "%s.png"%(name))
 
-    if True: # not os.path.exists(image_file):
-        with open(html_file,"wb") as fh:
-            raw = html_template.substitute(block=block)
-            fh.write(raw)
-
-        subprocess.check_call(['phantomjs', rasterize, html_file, image_file])
+    write_page(block, html_file)
+    partial = partial_image(output_dir, name)
+    governor.check_call('phantomjs', ['phantomjs', rasterize, html_file, partial])
+    os.rename(partial, image_file)
     return image_file
-    
-    
+
+def render_block_images(blocks, output_dir):
+    """Render each of blocks to output_dir/<sha1>.png, all with one phantomjs."""
+    batch_dir = make_tempdir()
+    try:
+        images = []
+        for block in blocks:
+            name = block_name(block)
+            html_file = os.path.join(batch_dir, "%s.html"%(name))
+            write_page(block, html_file)
+            images.append((html_file, partial_image(output_dir, name), os.path.join(output_dir, "%s.png"%(name))))
+
+        list_file = os.path.join(batch_dir, "blocks.txt")
+        with open(list_file, "w") as fh:
+            for html_file, partial, image_file in images:
+                fh.write("%s\t%s\n"%(html_file, partial))
+
+        governor.check_call('phantomjs_batch', ['phantomjs', rasterize_batch, list_file])
+        for html_file, partial, image_file in images:
+            os.rename(partial, image_file)
+    finally:
+        shutil.rmtree(batch_dir)
+
+def meta_string(meta, key):
+    value = meta.get(key)
+    if value and value['t'] == 'MetaString':
+        return value['c']
+
 def render_blocks(key, value, format, meta):
     if key == "CodeBlock":
         [[ident,classes,keyvals], code] = value
 
         if u"blocks" in classes or u"scratch" in classes:
-            image = block_to_image(code, os.getcwd())
             alt = Str(code)
+            store = meta_string(meta, store_key)
+            if store:
+                name = block_name(code)
+                # most blocks were rendered by build.py before pandoc ran
+                if not os.path.exists(os.path.join(store, "%s.png"%(name))):
+                    block_to_image(code, store)
+                return Para([Image([alt], ["%s%s.png"%(store_url, name),""])])
+
+            image = block_to_image(code, os.getcwd())
             return Para([Image([alt], [os.path.basename(image),""])])
 
 
@@ -56,12 +114,9 @@ def log(*a):
 
 if __name__ == '__main__':
     try:
-        tempdir = mkdtemp()
-        shutil.copytree(scratchblocks2, os.path.join(tempdir, "scratchblocks2"))
-        shutil.copy(jquery, tempdir)
+        tempdir = make_tempdir()
 
-        toJSONFilter(render_blocks)
+        toJSONFilter(render_blocks, types=["CodeBlock"])
 
     finally:
         shutil.rmtree(tempdir)
-
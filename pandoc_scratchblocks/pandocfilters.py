@@ -10,34 +10,56 @@ AST serialized as JSON.
 import sys
 import json
 
-def walk(x, action, format, meta):
+def walk(x, action, format, meta, types=None):
   """Walk a tree, applying an action to every object.
   Returns a modified tree.
+
+  The tree is walked without recursion, and changed in place: only the
+  lists holding replaced objects are altered. If types is given, the
+  action is only applied to objects of those types, and the contents of
+  objects that hold no other objects (Str, Code, CodeBlock, ...) are not
+  walked at all.
   """
-  if isinstance(x, list):
-    array = []
-    for item in x:
-      if isinstance(item, dict) and 't' in item:
-        res = action(item['t'], item['c'], format, meta)
-        if res is None:
-          array.append(walk(item, action, format, meta))
-        elif isinstance(res, list):
-          for z in res:
-            array.append(walk(z, action, format, meta))
-        else:
-          array.append(walk(res, action, format, meta))
+  if types is not None:
+    types = frozenset(types)
+  # each frame is [list, index of the next item, index before which
+  # items are replacements, walked without applying the action]
+  stack = [[[x], 0, 1]]
+  while stack:
+    frame = stack[-1]
+    array, i, replaced = frame
+    if i >= len(array):
+      stack.pop()
+      continue
+    item = array[i]
+    frame[1] = i + 1
+    if isinstance(item, dict):
+      if 't' in item:
+        key = item['t']
+        if i >= replaced and (types is None or key in types):
+          res = action(key, item.get('c'), format, meta)
+          if res is not None:
+            if not isinstance(res, list):
+              res = [res]
+            array[i:i+1] = res
+            frame[1] = i
+            frame[2] = i + len(res)
+            continue
+        if types is not None and key in _leaves:
+          continue
+        children = [item['c']] if 'c' in item else []
       else:
-        array.append(walk(item, action, format, meta))
-    return array
-  elif isinstance(x, dict):
-    obj = {}
-    for k in x:
-      obj[k] = walk(x[k], action, format, meta)
-    return obj
-  else:
-    return x
+        children = list(item.values())
+      stack.append([children, 0, len(children)])
+    elif isinstance(item, list):
+      stack.append([item, 0, 0])
+  return x
+
+# Objects with nothing walkable inside them
+_leaves = frozenset(['Str', 'Space', 'SoftBreak', 'LineBreak', 'Code', 'Math',
+  'RawInline', 'CodeBlock', 'RawBlock', 'HorizontalRule', 'Null'])
 
-def toJSONFilter(action):
+def toJSONFilter(action, types=None):
   """Converts an action into a filter that reads a JSON-formatted
   pandoc document from stdin, transforms it by walking the tree
   with the action, and returns a new JSON-formatted pandoc document
@@ -51,15 +73,17 @@ def toJSONFilter(action):
   will remain unchanged.  If it returns an object, the object will
   be replaced.  If it returns a list, the list will be spliced in to
   the list to which the target object belongs.  (So, returning an
-  empty list deletes the object.)
+  empty list deletes the object.)  If types is given, the action is
+  only applied to objects of those types, see walk.
   """
   doc = json.loads(sys.stdin.read())
   if len(sys.argv) > 1:
     format = sys.argv[1]
   else:
     format = ""
-  altered = walk(doc, action, format, doc[0]['unMeta'])
-  json.dump(altered, sys.stdout)
+  altered = walk(doc, action, format, doc[0]['unMeta'], types)
+  # dumps, unlike dump, uses the C encoder when it is available
+  sys.stdout.write(json.dumps(altered))
 
 def stringify(x):
   """Walks the tree x and returns concatenated string content,
@@ -0,0 +1,53 @@
+// Renders several scratchblocks pages with one phantomjs, for the blocks
+// build.py finds before running pandoc.
+//
+// Usage: rasterize_batch.js listfile
+// where each line of listfile is: page.html<tab>image.png
+
+var fs = require('fs'),
+    system = require('system'),
+    jobs;
+
+if (system.args.length !== 2) {
+    console.log('Usage: rasterize_batch.js listfile');
+    phantom.exit(1);
+} else {
+    jobs = fs.read(system.args[1]).split('\n').filter(function (line) {
+        return line.length > 0;
+    }).map(function (line) {
+        return line.split('\t');
+    });
+    next();
+}
+
+function next() {
+    if (jobs.length === 0) {
+        phantom.exit(0);
+        return;
+    }
+    var job = jobs.shift(),
+        page = require('webpage').create();
+    page.viewportSize = { width: 600, height: 600 };
+    page.open(job[0], function (status) {
+        if (status !== 'success') {
+            console.log('Unable to load ' + job[0]);
+            phantom.exit(1);
+            return;
+        }
+        // nb. this works because 'main' element is a table-cell
+        page.clipRect = page.evaluate(function(){
+            var clipRect = document.getElementById('main').getBoundingClientRect();
+            return {
+                top: clipRect.top,
+                left: clipRect.left,
+                width: clipRect.width,
+                height: clipRect.height
+            };
+        });
+        window.setTimeout(function () {
+            page.render(job[1]);
+            page.close();
+            next();
+        }, 200);
+    });
+}
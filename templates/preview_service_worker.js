@@ -0,0 +1,26 @@
+// Served by the preview (build.py --serve) in place of each term's service
+// worker. A worker left by a full build, in the output directory or in
+// the browser, would serve pages from its cache and hide every edit, so
+// this one empties the caches, unregisters itself and reloads the pages.
+
+self.addEventListener("install", function () {
+    self.skipWaiting();
+});
+
+self.addEventListener("activate", function (event) {
+    event.waitUntil(
+        caches.keys().then(function (keys) {
+            return Promise.all(keys.map(function (key) {
+                return caches.delete(key);
+            }));
+        }).then(function () {
+            return self.registration.unregister();
+        }).then(function () {
+            return self.clients.matchAll({type: "window"});
+        }).then(function (clients) {
+            clients.forEach(function (client) {
+                client.navigate(client.url);
+            });
+        })
+    );
+});
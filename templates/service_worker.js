@@ -0,0 +1,97 @@
+// Keeps a term's pages, images, stylesheets and fonts cached for offline
+// use. Written by build.py for each term: the files to cache, and the
+// revision of each, are listed in the precache manifest next to it.
+
+var CACHE = "${cache}";
+var MANIFEST = "${manifest}";
+var VERSION = "${version}";
+var REVISIONS = "__revisions__";
+// Resized images are named by their content, so are never out of date.
+// They are not precached, only the one the browser picks from srcset is
+// kept, the first time it is shown.
+var RESIZED = new URL("/embeds/", self.location).href;
+
+function fetchInto(cache, url) {
+    return fetch(url, {cache: "reload"}).then(function (response) {
+        if (!response.ok) {
+            throw new Error("Could not fetch " + url);
+        }
+        return cache.put(url, response);
+    });
+}
+
+self.addEventListener("install", function (event) {
+    event.waitUntil(
+        fetch(MANIFEST + "?v=" + VERSION, {cache: "reload"}).then(function (response) {
+            return response.json();
+        }).then(function (entries) {
+            return caches.open(CACHE).then(function (cache) {
+                return cache.match(REVISIONS).then(function (response) {
+                    return response ? response.json() : {};
+                }).then(function (cached) {
+                    var revisions = {};
+                    return Promise.all(entries.map(function (entry) {
+                        var url = new URL(entry.url, self.location).href;
+                        revisions[url] = entry.revision;
+                        // only fetch what has changed since the last install
+                        if (cached[url] === entry.revision) {
+                            return cache.match(url).then(function (response) {
+                                return response || fetchInto(cache, url);
+                            });
+                        }
+                        return fetchInto(cache, url);
+                    })).then(function () {
+                        return cache.put(REVISIONS, new Response(JSON.stringify(revisions)));
+                    });
+                });
+            });
+        }).then(function () {
+            return self.skipWaiting();
+        })
+    );
+});
+
+self.addEventListener("activate", function (event) {
+    event.waitUntil(
+        caches.open(CACHE).then(function (cache) {
+            return cache.match(REVISIONS).then(function (response) {
+                return response ? response.json() : {};
+            }).then(function (revisions) {
+                return cache.keys().then(function (requests) {
+                    var revisionsUrl = new URL(REVISIONS, self.location).href;
+                    return Promise.all(requests.filter(function (request) {
+                        return request.url !== revisionsUrl && !(request.url in revisions) &&
+                            request.url.indexOf(RESIZED) !== 0;
+                    }).map(function (request) {
+                        return cache.delete(request);
+                    }));
+                });
+            });
+        }).then(function () {
+            return self.clients.claim();
+        })
+    );
+});
+
+self.addEventListener("fetch", function (event) {
+    if (event.request.method !== "GET") {
+        return;
+    }
+    event.respondWith(
+        caches.open(CACHE).then(function (cache) {
+            return cache.match(event.request, {ignoreSearch: true}).then(function (response) {
+                if (response) {
+                    return response;
+                }
+                return fetch(event.request).then(function (response) {
+                    // keep the images the pages show, at the size shown
+                    var url = new URL(event.request.url);
+                    if (response.ok && event.request.destination === "image" && url.origin === self.location.origin) {
+                        cache.put(event.request, response.clone());
+                    }
+                    return response;
+                });
+            });
+        })
+    );
+});
@@ -0,0 +1,69 @@
+"""
+Stands in for pandoc and phantomjs, so whole builds can be run in tests.
+
+Pandoc's output is the command line it was given, with the site's output
+directory left out, so any change in what a page is built from, or in the
+order it is given, shows up in the page.
+"""
+import os
+import sys
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import build
+import governor
+
+example_term = os.path.join(build.base, "example_term")
+
+# the output directory of the build in progress
+site_dir = None
+
+def check_call(tool, cmd, cwd=None):
+    if tool == "pandoc":
+        output_file = cmd[cmd.index("-o") + 1]
+        with open(output_file, "w") as fh:
+            for arg in cmd[1:]:
+                if isinstance(arg, unicode):
+                    arg = arg.encode('utf-8')
+                fh.write(arg.replace(site_dir, "OUT") + "\n")
+    elif tool == "phantomjs_batch":
+        with open(cmd[2]) as fh:
+            for line in fh:
+                html_file, image_file = line.rstrip("\n").split("\t")
+                with open(html_file, "rb") as page, open(image_file, "wb") as image:
+                    image.write(page.read())
+    else:
+        raise AssertionError("unexpected %s"%tool)
+    return 0
+
+def call(tool, cmd, cwd=None):
+    return check_call(tool, cmd, cwd)
+
+class StubTools(object):
+    """Replaces the external tools while in use, and keeps what is printed."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def __enter__(self):
+        global site_dir
+        site_dir = self.output_dir
+        self.saved = governor.check_call, governor.call, sys.stdout, os.environ.get('SOURCE_DATE_EPOCH')
+        governor.check_call, governor.call = check_call, call
+        # zip files are written by write_zip rather than zip
+        os.environ['SOURCE_DATE_EPOCH'] = str(build.zip_epoch)
+        sys.stdout = self.output = StringIO.StringIO()
+        return self
+
+    def __exit__(self, *exc):
+        governor.check_call, governor.call, sys.stdout, epoch = self.saved
+        if epoch is None:
+            os.environ.pop('SOURCE_DATE_EPOCH')
+        else:
+            os.environ['SOURCE_DATE_EPOCH'] = epoch
+
+def build_example(output_dir, **options):
+    """Build the example term for the uk theme, returning what was printed."""
+    with StubTools(output_dir) as tools:
+        build.build([example_term], build.THEMES['uk'], dict(build.LANGUAGES), output_dir, **options)
+    return tools.output.getvalue()
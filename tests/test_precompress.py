@@ -0,0 +1,29 @@
+"""
+Checks that --precompress only compresses what has changed. Run with:
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from stub_tools import build_example
+
+class PrecompressTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="lesson_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unchanged_build_compresses_nothing(self):
+        first = build_example(self.dir, precompress=True)
+        self.assertNotIn("Compressed 0 of", first)
+
+        second = build_example(self.dir, precompress=True)
+        self.assertIn("Compressed 0 of", second)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "img", "check.svg.gz")))
+
+if __name__ == '__main__':
+    unittest.main()
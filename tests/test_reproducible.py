@@ -0,0 +1,113 @@
+"""
+Checks that the build writes the same bytes from the same sources, without
+needing pandoc or phantomjs. Run with:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import build
+from stub_tools import build_example
+
+def write(filename, data, mtime=None, mode=None):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, "wb") as fh:
+        fh.write(data)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+    if mode is not None:
+        os.chmod(filename, mode)
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="lesson_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+class WriteZipTest(TempDirTest):
+    def make_sources(self, name, mtime, mode, order):
+        source_dir = self.path(name)
+        files = [
+            os.path.join(source_dir, "project.sb"),
+            os.path.join(source_dir, "images", "sprite.png"),
+            os.path.join(source_dir, "readme.txt"),
+        ]
+        for filename in files:
+            write(filename, "contents of %s"%os.path.basename(filename), mtime, mode)
+        return source_dir, [files[i] for i in order]
+
+    def test_same_bytes_whatever_the_mtimes_modes_and_order(self):
+        left_dir, left_files = self.make_sources("left", 1000000000, 0644, [0, 1, 2])
+        right_dir, right_files = self.make_sources("right", 1400000000, 0600, [2, 0, 1])
+
+        build.write_zip(left_dir, left_files, self.path("left.zip"), build.zip_epoch)
+        build.write_zip(right_dir, right_files, self.path("right.zip"), build.zip_epoch)
+
+        with open(self.path("left.zip"), "rb") as left, open(self.path("right.zip"), "rb") as right:
+            self.assertEqual(left.read(), right.read())
+
+    def test_timestamp_before_zip_epoch(self):
+        source_dir, files = self.make_sources("early", 0, 0644, [0, 1, 2])
+        build.write_zip(source_dir, files, self.path("early.zip"), 0)
+        build.write_zip(source_dir, files, self.path("epoch.zip"), build.zip_epoch)
+
+        with open(self.path("early.zip"), "rb") as early, open(self.path("epoch.zip"), "rb") as epoch:
+            self.assertEqual(early.read(), epoch.read())
+
+class OrderTest(TempDirTest):
+    names = ["c.md", "a.md", "b.md", "a.txt"]
+
+    def test_expand_glob_is_sorted(self):
+        for name in self.names:
+            write(self.path(name), "")
+        self.assertEqual(build.expand_glob(self.dir, ["*.md", "*.txt"]),
+            [self.path(n) for n in ["a.md", "b.md", "c.md", "a.txt"]])
+
+    def test_find_files_is_sorted(self):
+        for sub in ["z", "m", "a"]:
+            for name in self.names:
+                write(self.path(sub, name), "")
+        found = build.find_files([self.path("z"), self.path("a"), self.path("m")], ".md")
+        self.assertEqual(found, sorted(found))
+        self.assertEqual(len(found), 9)
+
+class CompareTreesTest(TempDirTest):
+    def test_lists_changed_added_and_removed_files(self):
+        for side in ["left", "right"]:
+            write(self.path(side, "same.html"), "same")
+            write(self.path(side, "sub", "changed.html"), "from %s"%side)
+        write(self.path("left", "only_left.zip"), "")
+        write(self.path("right", "sub", "only_right.css"), "")
+
+        self.assertEqual(build.compare_trees(self.path("left"), self.path("right")),
+            ["only_left.zip", os.path.join("sub", "changed.html"), os.path.join("sub", "only_right.css")])
+
+    def test_identical_trees(self):
+        for side in ["left", "right"]:
+            write(self.path(side, "a", "index.html"), "page", mtime=1000 if side == "left" else 2000)
+        self.assertEqual(build.compare_trees(self.path("left"), self.path("right")), [])
+
+class BuildTest(TempDirTest):
+    def test_two_builds_are_identical(self):
+        build_example(self.path("first"), precompress=True)
+        build_example(self.path("second"), precompress=True)
+        self.assertEqual(build.compare_trees(self.path("first"), self.path("second")), [])
+
+    def test_building_part_of_the_site_again_changes_nothing(self):
+        build_example(self.path("full"))
+        build_example(self.path("part"))
+        build_example(self.path("part"), selection=build.make_selection(projects=[2]))
+        self.assertEqual(build.compare_trees(self.path("full"), self.path("part")), [])
+
+if __name__ == '__main__':
+    unittest.main()